@@ -0,0 +1,46 @@
+"""
+Run any subset of the pipeline stages in a single process.
+
+The stages are run in the order 'download', 'preprocess', 'merge', 'timeseries' and 'analyze'. Each
+stage hands its results directly to the next stage in memory, while a background thread writes them
+to disk as checkpoints. Stages that are not selected are skipped, in which case the next stage reads
+its input from the checkpoint on disk instead.
+
+Usage:
+    python -m src                                  # run all stages
+    python -m src pipeline.stages=[merge,analyze]  # only rerun merge and analyze
+"""
+import hydra
+from src import download, preprocess, merge, timeseries, analyze
+from src.utils.checkpoints import CheckpointWriter
+
+STAGES = ('download', 'preprocess', 'merge', 'timeseries', 'analyze')
+
+
+@hydra.main(version_base=None, config_path='../config', config_name='main.yaml')
+def main(config):
+    """
+    Run the selected pipeline stages.
+    """
+    stages = config.pipeline.stages
+
+    unknown = set(stages) - set(STAGES)
+    if unknown:
+        raise ValueError(f'Unknown pipeline stages: {sorted(unknown)}. Choose from {STAGES}.')
+
+    # Raw data is modified in place during preprocessing, so it is written before moving on
+    raw = download.run(config) if 'download' in stages else {}
+
+    with CheckpointWriter() as writer:
+        interim = preprocess.run(config, **raw, writer=writer) if 'preprocess' in stages else {}
+        merged = merge.run(config, **interim, writer=writer) if 'merge' in stages else None
+
+        if 'timeseries' in stages:
+            timeseries.run(config, interim.get('vitals'), merged, writer=writer)
+
+        if 'analyze' in stages:
+            analyze.run(config, merged, writer=writer)
+
+
+if __name__ == "__main__":
+    main() # pylint: disable=E1120
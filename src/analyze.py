@@ -1,11 +1,33 @@
+from concurrent.futures import ProcessPoolExecutor
+from functools import reduce
+from itertools import repeat
+import multiprocessing
 from pathlib import Path
-from scipy.stats import pearsonr
 import numpy as np
 import pandas as pd
+import pyarrow as pa
+from pyarrow import ipc
 import hydra
+from src.merge import ROLLING_VITALS, ZSCORE_KEYS
+from src.utils.checkpoints import CheckpointWriter, save_checkpoint
+
+# Columns of the merged data between which population-level correlations are computed
+DIFFERENCES = [
+    f'{vital}{suffix}'
+    for vital in ROLLING_VITALS for suffix in ('difference', 'difference_relative')
+]
+POPULATION_COLUMNS = (
+    ZSCORE_KEYS
+    + [f'{key}_Z' for key in ZSCORE_KEYS]
+    + ROLLING_VITALS
+    + [f'{vital}{subset}' for subset in ('weekday', 'weekend') for vital in ROLLING_VITALS]
+    + ['social_jetlag' if key == 'midsleepdifference' else key for key in DIFFERENCES]
+)
 
 
 def corrcoef(group, question_key, vital_key):
+    # scipy is slow to import, so only load it once correlations are actually computed
+    from scipy.stats import pearsonr # pylint: disable=C0415
 
     x = group[vital_key]
     y = group[question_key]
@@ -24,9 +46,8 @@ def corrcoef(group, question_key, vital_key):
     return corr, p_value, n
 
 
-def compute_pearson_correlation(input_file, output_file):
+def compute_pearson_correlation(df):
 
-    df = pd.read_feather(input_file)
     g = df.groupby(['userid', 'deviceid'])
 
     corr = g.size().reset_index().drop(columns=0)
@@ -46,19 +67,251 @@ def compute_pearson_correlation(input_file, output_file):
             corr = pd.merge(corr, _corr, on=['userid', 'deviceid'])
 
     corr.reset_index(inplace=True, drop=True)
-    corr.to_feather(output_file)
 
+    return corr
 
-@hydra.main(version_base=None, config_name='main.yaml', config_path='../config/')
-def main(config):
 
-    input_file = Path(config.data.processed) / config.data.filenames.merged_data
+def comoments(values):
+    """
+    Pairwise-complete co-moments of the columns of a 2D array.
+
+    Entry [i, j] of each returned array refers to the rows in which both column i and column j are
+    finite. Columns are shifted by their mean before summing to avoid cancellation.
+
+    Args:
+        values (numpy.ndarray): Array of shape (rows, columns).
+
+    Returns:
+        dict of numpy.ndarray: The number of rows 'n', the mean of column i 'mean', the sum of
+            squared deviations of column i 'm2' and the sum of products of deviations of column i
+            and j 'c' for each pair of columns.
+    """
+    valid = np.isfinite(values)
+    weights = valid.astype(float)
+
+    count = weights.sum(axis=0)
+    shift = np.divide(
+        np.where(valid, values, 0).sum(axis=0), count, out=np.zeros_like(count), where=count > 0
+    )
+    centered = np.where(valid, values - shift, 0)
+
+    n = weights.T @ weights
+    sums = centered.T @ weights
+    mean = np.divide(sums, n, out=np.zeros_like(n), where=n > 0)
+
+    return {
+        'n': n,
+        'mean': mean + shift[:, None],
+        'm2': (centered**2).T @ weights - sums * mean,
+        'c': centered.T @ centered - sums * mean.T,
+    }
+
+
+def merge_comoments(a, b):
+    """
+    Combine the co-moments of two disjoint sets of rows (Chan et al., 1979).
+
+    Args:
+        a (dict of numpy.ndarray): Co-moments as returned by comoments().
+        b (dict of numpy.ndarray): Co-moments as returned by comoments().
+
+    Returns:
+        dict of numpy.ndarray: The co-moments of the union of both sets of rows.
+    """
+    n = a['n'] + b['n']
+    delta = b['mean'] - a['mean']
+    weight = np.divide(b['n'], n, out=np.zeros_like(n), where=n > 0)
+
+    return {
+        'n': n,
+        'mean': a['mean'] + delta * weight,
+        'm2': a['m2'] + b['m2'] + delta**2 * a['n'] * weight,
+        'c': a['c'] + b['c'] + delta * delta.T * a['n'] * weight,
+    }
+
+
+def merge_partial_comoments(a, b):
+    """
+    Combine two dicts of co-moments per stratum as returned by population_comoments().
+    """
+    merged = dict(a)
+
+    for stratum, moments in b.items():
+        if stratum in merged:
+            moments = merge_comoments(merged[stratum], moments)
+
+        merged[stratum] = moments
+
+    return merged
+
+
+def population_comoments(chunks, columns, by=()):
+    """
+    Accumulate co-moments over a sequence of chunks of the merged data.
+
+    Args:
+        chunks (iterable of pandas.DataFrame): The chunks of the merged data.
+        columns (list of str): The columns between which co-moments are computed.
+        by (list of str, optional): Columns by which the population is additionally stratified.
+            Defaults to (), i.e., only the whole population.
+
+    Returns:
+        dict: Co-moments as returned by comoments() for each stratum. Strata are given as tuple of
+            the stratifying column and its value, or ('all', None) for the whole population.
+    """
+    partial = {}
+
+    for chunk in chunks:
+        values = chunk[columns].to_numpy(dtype=float)
+        strata = {('all', None): values}
+
+        for key in by:
+            codes, groups = pd.factorize(chunk[key])
+            for code, group in enumerate(groups):
+                strata[(key, group)] = values[codes == code]
+
+        partial = merge_partial_comoments(
+            partial, {stratum: comoments(rows) for stratum, rows in strata.items()}
+        )
+
+    return partial
+
+
+def feather_chunks(path, columns, first, last):
+    """
+    Read record batches of a feather file one by one.
+    """
+    reader = ipc.open_file(pa.memory_map(str(path)))
+
+    for batch in range(first, last):
+        yield reader.get_batch(batch).select(columns).to_pandas()
+
+
+def batch_comoments(path, columns, by, first, last):
+    """
+    Accumulate co-moments over a range of record batches of a feather file.
+    """
+    return population_comoments(feather_chunks(path, columns + by, first, last), columns, by)
+
+
+def feather_comoments(path, columns, by=(), processes=1):
+    """
+    Accumulate co-moments over the record batches of a feather file in a pool of processes.
+
+    Args:
+        path (str): Path to the feather file with the merged data.
+        columns (list of str): The columns between which co-moments are computed.
+        by (list of str, optional): Columns by which the population is additionally stratified.
+            Defaults to ().
+        processes (int, optional): The number of processes. Defaults to 1.
+
+    Returns:
+        dict: Co-moments per stratum as returned by population_comoments().
+    """
+    batches = ipc.open_file(pa.memory_map(str(path))).num_record_batches
+    bounds = np.linspace(0, batches, min(batches, 4 * processes) + 1).astype(int)
+    tasks = (repeat(path), repeat(list(columns)), repeat(list(by)), bounds[:-1], bounds[1:])
+
+    if processes == 1:
+        return reduce(merge_partial_comoments, map(batch_comoments, *tasks), {})
+
+    # Do not fork, since the background thread of a CheckpointWriter may be writing at this point
+    context = multiprocessing.get_context('spawn')
+
+    with ProcessPoolExecutor(processes, mp_context=context) as executor:
+        return reduce(merge_partial_comoments, executor.map(batch_comoments, *tasks), {})
+
+
+def population_correlations(partial, columns):
+    """
+    Compute correlation and covariance matrices from co-moments.
+
+    Args:
+        partial (dict): Co-moments per stratum as returned by population_comoments().
+        columns (list of str): The columns the co-moments were computed for.
+
+    Returns:
+        pandas.DataFrame: One row per stratum and pair of columns with the number of rows 'N' in
+            which both columns are available, their Pearson correlation 'corr' and covariance 'cov'.
+            Empty if there are no co-moments, e.g., for empty merged data.
+    """
+    frames = []
+
+    for (by, group), moments in partial.items():
+        n = moments['n']
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            corr = moments['c'] / np.sqrt(moments['m2'] * moments['m2'].T)
+            cov = np.where(n > 1, moments['c'] / (n - 1), np.nan)
+
+        frames.append(pd.DataFrame({
+            'by': by,
+            'group': None if group is None else str(group),
+            'x': np.repeat(columns, len(columns)),
+            'y': np.tile(columns, len(columns)),
+            'N': n.ravel().astype(int),
+            'corr': corr.ravel(),
+            'cov': cov.ravel(),
+        }))
+
+    if not frames:
+        return pd.DataFrame({
+            'by': pd.Series(dtype=object),
+            'group': pd.Series(dtype=object),
+            'x': pd.Series(dtype=object),
+            'y': pd.Series(dtype=object),
+            'N': pd.Series(dtype=int),
+            'corr': pd.Series(dtype=float),
+            'cov': pd.Series(dtype=float),
+        })
+
+    return pd.concat(frames, ignore_index=True)
+
+
+def run(config, df=None, writer=None):
+
+    merged_file = Path(config.data.processed) / config.data.filenames.merged_data
 
     output_folder = Path(config.compute.folder)
     output_folder.mkdir(parents=True, exist_ok=True)
-    output_file = output_folder / config.compute.filenames.correlations
 
-    compute_pearson_correlation(input_file=input_file, output_file=output_file)
+    corr = None
+
+    if 'individual' in config.compute.stages:
+        if df is None:
+            df = pd.read_feather(merged_file)
+
+        corr = compute_pearson_correlation(df)
+        save_checkpoint(corr, output_folder / config.compute.filenames.correlations, writer)
+
+    if 'population' in config.compute.stages:
+        print('Computing population-level correlations...')
+        population = config.compute.population
+        by = list(population.by)
+
+        # Without data in memory stream over the merged data on disk
+        if df is None:
+            partial = feather_comoments(merged_file, POPULATION_COLUMNS, by, population.processes)
+        else:
+            chunks = (
+                df.iloc[start:start + population.chunksize]
+                for start in range(0, len(df), population.chunksize)
+            )
+            partial = population_comoments(chunks, POPULATION_COLUMNS, by)
+
+        save_checkpoint(
+            population_correlations(partial, POPULATION_COLUMNS),
+            output_folder / config.compute.filenames.population_correlations,
+            writer
+        )
+
+    return corr
+
+
+@hydra.main(version_base=None, config_name='main.yaml', config_path='../config/')
+def main(config):
+    with CheckpointWriter() as writer:
+        run(config, writer=writer)
 
 
 if __name__ == '__main__':
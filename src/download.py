@@ -5,13 +5,15 @@ Specifically download (i) the WHO-5 responses from the survey data, (ii) all rel
 for the time period covered by the survey data, and (iii) additional user data from a pre-computed
 table.
 
-This script does not do any preprocessing but downloads the data as is. All data is stored in
+Vital data is either downloaded with one row per vital or, if 'download.pivot_vitals' is set, with
+one column per vital, which transfers far less data.
+
+Apart from the optional pivoting of the vital data this script does not do any preprocessing but
+downloads the data as is. All data is stored in
 'data/01_raw'
 """
 import os
 from pathlib import Path
-from dotenv import load_dotenv
-import psycopg2
 import pandas as pd
 import numpy as np
 import hydra
@@ -27,6 +29,10 @@ def connector():
         connection:
             The data base connector.
     """
+    # Only needed for downloads, so avoid the import cost in all other pipeline stages
+    from dotenv import load_dotenv # pylint: disable=C0415
+    import psycopg2 # pylint: disable=C0415
+
     load_dotenv()
 
     conn = psycopg2.connect(**{
@@ -157,6 +163,62 @@ def get_vitals(user_ids, min_date="2021-09-01"):
     return vitals
 
 
+def get_vitals_wide(user_ids, min_date="2021-09-01", max_date="2022-12-31"):
+    """
+    Get vital data from the data base with one column per vital.
+
+    Same as get_vitals() but the data is put as columns in the data base, so that only a single row
+    per user, date and device is transferred. Sleep onset and offset are already corrected for the
+    timezone and only dates within the given bounds are returned.
+
+    Args:
+        user_ids (int or list/array of int):
+            User ids for which to retrieve the vital data.
+        min_date (str, optional):
+            The minimum allowed date of vital data. Defaults to "2021-09-01".
+        max_date (str, optional):
+            The maximum allowed date of vital data. Defaults to "2022-12-31", the end of the data
+            collection.
+
+    Returns:
+        pandas.DataFrame:
+            The vital data with the columns userid, date, deviceid, v9, v43, v52, v53 and v65.
+    """
+    user_ids = tuple_of_user_ids(user_ids)
+
+    query = f"""
+    SELECT
+        user_id AS userid,
+        date,
+        source AS deviceid,
+        MAX(value) FILTER (WHERE type = 9) AS v9,
+        MAX(value) FILTER (WHERE type = 43) AS v43,
+        MAX(value + 60 * COALESCE(timezone_offset, 0)) FILTER (WHERE type = 52) AS v52,
+        MAX(value + 60 * COALESCE(timezone_offset, 0)) FILTER (WHERE type = 53) AS v53,
+        MAX(value) FILTER (WHERE type = 65) AS v65
+    FROM
+        datenspende.vitaldata
+    WHERE
+        vitaldata.user_id IN {user_ids}
+    AND
+        vitaldata.type IN (9, 65, 43, 52, 53)
+    AND
+        vitaldata.date >= '{min_date}'
+    AND
+        vitaldata.date <= '{max_date}'
+    AND
+        (timezone_offset IS NULL or timezone_offset IN (0, 60, 120))
+    GROUP BY
+        user_id, date, source
+    ORDER BY
+        user_id, date, source
+    """
+
+    vitals = run_query(query)
+
+    return vitals
+
+
 def get_users(user_ids):
     """
     Get user data from the data base.
@@ -198,12 +260,16 @@ def get_users(user_ids):
     return users
 
 
-@hydra.main(version_base=None, config_path='../config/', config_name='main.yaml')
-def main(config):
-    """
-    Download survey, vital and user data from the data base.
+def run(config):
     """
+    Download survey, vital and user data from the data base and store it in 'data/01_raw'.
 
+    Args:
+        config (omegaconf.DictConfig): The hydra configuration.
+
+    Returns:
+        dict: The raw survey, vital and user data.
+    """
     output_path = Path(config.data.raw)
     output_path.mkdir(parents=True, exist_ok=True)
 
@@ -213,7 +279,10 @@ def main(config):
 
     print('Downloading vital data...')
     user_ids = survey_data.user_id.unique()
-    vitals = get_vitals(user_ids)
+    if config.download.pivot_vitals:
+        vitals = get_vitals_wide(user_ids)
+    else:
+        vitals = get_vitals(user_ids)
     vitals.to_feather(output_path / config.data.filenames.vitals)
 
     print('Downloading user data...')
@@ -222,6 +291,16 @@ def main(config):
 
     print('Done!')
 
+    return {'surveys': survey_data, 'vitals': vitals, 'users': users}
+
+
+@hydra.main(version_base=None, config_path='../config/', config_name='main.yaml')
+def main(config):
+    """
+    Download survey, vital and user data from the data base.
+    """
+    run(config)
+
 
 if __name__ == "__main__":
     main() # pylint: disable=E1120
@@ -0,0 +1,287 @@
+"""
+Cache the external geodata in binary formats that are fast to load.
+
+Specifically, this stores (i) the NUTS3 geometries from 'nuts3de.json' as GeoParquet with one
+pre-simplified geometry column per tolerance, and (ii) the cleaned mapping of zip codes to NUTS3
+codes as an integer-indexed lookup array. Map plots and the geocoding of users can then skip
+parsing the GeoJSON and CSV files on every run.
+
+All cached files are stored next to the external data in 'data/00_external/cache'.
+"""
+from pathlib import Path
+import numpy as np
+import pandas as pd
+import hydra
+
+# German zip codes have five digits, so every valid code is an index into an array of this size
+NUMBER_OF_ZIP_CODES = 100000
+
+
+def geometry_column(tolerance):
+    """
+    Name of the column that holds the NUTS3 geometries simplified with a given tolerance.
+
+    Args:
+        tolerance (float or None): The simplification tolerance in degrees. None refers to the
+            original geometries.
+
+    Returns:
+        str: The column name.
+    """
+    if tolerance is None:
+        return 'geometry'
+
+    return f'geometry_{tolerance}'
+
+
+def cache_is_stale(source_file, cache_file):
+    """
+    Check whether a cache needs to be (re-)built from its source file.
+
+    Args:
+        source_file (pathlib.Path): The file the cache is built from.
+        cache_file (pathlib.Path): The cache file.
+
+    Returns:
+        bool: True if the cache does not exist or is older than the source file.
+    """
+    return not cache_file.exists() or cache_file.stat().st_mtime < source_file.stat().st_mtime
+
+
+def build_nuts3_cache(geojson_file, cache_file, tolerances):
+    """
+    Store the NUTS3 geometries as GeoParquet together with simplified versions of each geometry.
+
+    Args:
+        geojson_file (str): Path to the NUTS3 geometries. Typically stored in 'data/00_external'.
+        cache_file (str): Path to the desired GeoParquet file.
+        tolerances (list of float): Tolerances (in degrees) used to simplify the geometries.
+    """
+    # geopandas is slow to import and only needed for maps, so load it on demand
+    import geopandas as gpd # pylint: disable=C0415
+
+    gdf = gpd.read_file(geojson_file)
+
+    for tolerance in tolerances:
+        gdf[geometry_column(tolerance)] = gdf.geometry.simplify(tolerance, preserve_topology=True)
+
+    gdf.to_parquet(cache_file)
+
+
+def cached_tolerances(cache_file):
+    """
+    Get the tolerances of the simplified geometries stored in a NUTS3 cache.
+
+    Only the schema of the GeoParquet file is read.
+
+    Args:
+        cache_file (str): Path to the GeoParquet file created by build_nuts3_cache().
+
+    Returns:
+        list of float: The tolerances.
+    """
+    from pyarrow import parquet # pylint: disable=C0415
+
+    prefix = geometry_column(None) + '_'
+    names = parquet.read_schema(cache_file).names
+
+    return sorted(float(name[len(prefix):]) for name in names if name.startswith(prefix))
+
+
+def load_nuts3_geometries(geojson_file, cache_file, tolerance=None, tolerances=()):
+    """
+    Load the cached NUTS3 geometries at a given simplification level.
+
+    The cache is (re-)built from the GeoJSON file if it does not exist, is older than the GeoJSON
+    file or lacks the requested tolerance. A rebuilt cache holds all previously cached tolerances,
+    the given tolerances and the requested one. Only the requested geometry column is read from
+    disk.
+
+    Args:
+        geojson_file (str): Path to the NUTS3 geometries. Typically stored in 'data/00_external'.
+        cache_file (str): Path to the GeoParquet file created by build_nuts3_cache().
+        tolerance (float, optional): The simplification tolerance. Defaults to None, i.e., the
+            original geometries.
+        tolerances (list of float, optional): Further tolerances to cache if the cache needs to be
+            built. Defaults to ().
+
+    Returns:
+        geopandas.GeoDataFrame: The NUTS3 regions with columns 'id', 'name' and 'geometry'.
+    """
+    import geopandas as gpd # pylint: disable=C0415
+
+    geojson_file = Path(geojson_file)
+    cache_file = Path(cache_file)
+
+    available = [] if not cache_file.exists() else cached_tolerances(cache_file)
+
+    if (
+        cache_is_stale(geojson_file, cache_file)
+        or (tolerance is not None and tolerance not in available)
+    ):
+        tolerances = set(available) | set(tolerances)
+        if tolerance is not None:
+            tolerances.add(tolerance)
+
+        cache_file.parent.mkdir(parents=True, exist_ok=True)
+        build_nuts3_cache(geojson_file, cache_file, sorted(tolerances))
+        available = cached_tolerances(cache_file)
+
+    if tolerance is not None and tolerance not in available:
+        raise ValueError(
+            f'No geometries for tolerance {tolerance} in {cache_file}. Available: {available}.')
+
+    column = geometry_column(tolerance)
+    gdf = gpd.read_parquet(cache_file, columns=['id', 'name', column])
+
+    return gdf.rename_geometry('geometry') if column != 'geometry' else gdf
+
+
+def nuts3_index(gdf):
+    """
+    Build a spatial index over a set of NUTS3 geometries.
+
+    Use, e.g., nuts3_index(gdf).query(points, predicate='within') to find the regions that contain
+    a set of points. The returned positions refer to the rows of gdf.
+
+    Args:
+        gdf (geopandas.GeoDataFrame): The geometries as returned by load_nuts3_geometries().
+
+    Returns:
+        shapely.STRtree: The spatial index.
+    """
+    from shapely import STRtree # pylint: disable=C0415
+
+    return STRtree(gdf.geometry.values)
+
+
+def build_zip_to_nuts_cache(zip_to_nuts_mapping_file, cache_file):
+    """
+    Store the mapping of zip codes to NUTS3 codes as an integer-indexed lookup array.
+
+    The cache contains two arrays: 'codes' with all unique NUTS3 codes and 'index' with one entry
+    per possible zip code that holds the position of the corresponding NUTS3 code in 'codes' (or
+    -1 if the zip code does not exist).
+
+    Args:
+        zip_to_nuts_mapping_file (str): Path to a .csv file containing the mapping of zip codes to \
+            NUTS3. Typically stored in 'data/00_external'.
+        cache_file (str): Path to the desired .npz file.
+    """
+    plz = pd.read_csv(zip_to_nuts_mapping_file, sep=';', dtype=str)
+
+    plz.NUTS3 = plz.NUTS3.str.replace('\'', '')
+    plz.CODE = plz.CODE.str.replace('\'', '')
+
+    codes, nuts3 = pd.factorize(plz.NUTS3)
+
+    index = np.full(NUMBER_OF_ZIP_CODES, -1, dtype=np.int16)
+    index[plz.CODE.astype(int).values] = codes
+
+    np.savez(cache_file, index=index, codes=nuts3.values.astype(str))
+
+
+def load_zip_to_nuts(zip_to_nuts_mapping_file, cache_file):
+    """
+    Load the lookup array of zip codes to NUTS3 codes.
+
+    The cache is (re-)built from the .csv file if it does not exist or is older than the .csv file.
+
+    Args:
+        zip_to_nuts_mapping_file (str): Path to a .csv file containing the mapping of zip codes to \
+            NUTS3. Typically stored in 'data/00_external'.
+        cache_file (str): Path to the .npz file created by build_zip_to_nuts_cache().
+
+    Returns:
+        tuple of numpy.ndarray: The lookup array and the NUTS3 codes it refers to.
+    """
+    zip_to_nuts_mapping_file = Path(zip_to_nuts_mapping_file)
+    cache_file = Path(cache_file)
+
+    if cache_is_stale(zip_to_nuts_mapping_file, cache_file):
+        cache_file.parent.mkdir(parents=True, exist_ok=True)
+        build_zip_to_nuts_cache(zip_to_nuts_mapping_file, cache_file)
+
+    with np.load(cache_file) as cache:
+        return cache['index'], cache['codes']
+
+
+def zip_code_positions(zip_codes, index):
+    """
+    Look up the positions of the NUTS3 codes of a sequence of zip codes in the lookup array.
+
+    String zip codes are only parsed once per unique value, since there are far fewer distinct zip
+    codes than users.
+
+    Args:
+        zip_codes (pandas.Series): Zip codes as five-digit strings (e.g. '01067') or integers.
+        index (numpy.ndarray): The lookup array as returned by load_zip_to_nuts().
+
+    Returns:
+        numpy.ndarray: The position of the NUTS3 code for each zip code or -1 if it is unknown.
+    """
+    if pd.api.types.is_numeric_dtype(zip_codes):
+        valid = zip_codes.between(0, NUMBER_OF_ZIP_CODES - 1).values
+        numeric = zip_codes.where(valid, 0).astype(int).values
+
+        return np.where(valid, index[numeric], -1)
+
+    labels, uniques = pd.factorize(zip_codes)
+
+    uniques = pd.Series(uniques, dtype='string')
+    valid = (uniques.str.len().eq(5) & uniques.str.isdigit()).fillna(False).values
+    numeric = uniques.where(valid, '0').astype(int).values
+    unique_positions = np.where(valid, index[numeric], -1)
+
+    # Missing zip codes are labeled -1 by pd.factorize()
+    return np.where(labels >= 0, unique_positions[labels], -1)
+
+
+def zip_to_nuts3(zip_codes, index, codes):
+    """
+    Look up the NUTS3 codes of a sequence of five-digit zip codes.
+
+    Args:
+        zip_codes (pandas.Series): Zip codes as five-digit strings (e.g. '01067') or integers.
+        index (numpy.ndarray): The lookup array as returned by load_zip_to_nuts().
+        codes (numpy.ndarray): The NUTS3 codes as returned by load_zip_to_nuts().
+
+    Returns:
+        numpy.ndarray: The NUTS3 code for each zip code or NaN if the zip code is unknown.
+    """
+    positions = zip_code_positions(zip_codes, index)
+
+    nuts3 = np.full(len(positions), np.nan, dtype=object)
+    known = positions >= 0
+    nuts3[known] = codes.astype(object)[positions[known]]
+
+    return nuts3
+
+
+@hydra.main(version_base=None, config_path='../config', config_name='main.yaml')
+def main(config):
+    """
+    Build the caches of NUTS3 geometries and of the mapping of zip codes to NUTS3 codes.
+    """
+    external_path = Path(config.data.external)
+    cache_path = Path(config.data.cache)
+    cache_path.mkdir(parents=True, exist_ok=True)
+
+    print('Cache NUTS3 geometries...')
+    build_nuts3_cache(
+        geojson_file=external_path / config.data.filenames.nuts3,
+        cache_file=cache_path / config.data.filenames.nuts3_cache,
+        tolerances=config.geocache.tolerances
+    )
+
+    print('Cache mapping of zip codes to NUTS3...')
+    build_zip_to_nuts_cache(
+        zip_to_nuts_mapping_file=external_path / config.data.filenames.zip_to_nuts,
+        cache_file=cache_path / config.data.filenames.zip_to_nuts_cache
+    )
+
+    print('Done!')
+
+
+if __name__ == "__main__":
+    main() # pylint: disable=E1120
@@ -10,9 +10,55 @@ from pathlib import Path
 import pandas as pd
 import numpy as np
 import hydra
+from src.mergestate import (
+    fingerprint, get_changed_rows, get_merge_state, file_signature, save_merge_state,
+    load_merge_state, input_digest, save_windows, load_windows
+)
+from src.utils.checkpoints import CheckpointWriter, save_checkpoint
 
+# Survey responses for which Z-scores are computed and the criteria that define the sub-populations
+ZSCORE_KEYS = ['q49', 'q50', 'q54', 'q55', 'q56', 'total_wellbeing']
+ZSCORE_BY = ['salutation', 'birth_date']
 
-def get_dummy_entries(surveys, vitals):
+# The length of the window of the rolling averages and the vitals that are averaged
+WINDOW = pd.Timedelta(days=28)
+ROLLING_VITALS = ['v9', 'v43', 'v65', 'v52', 'v53', 'midsleep']
+
+
+def pack_keys(userid, date, deviceid):
+    """
+    Pack combinations of userid, date and deviceid into single int64 keys.
+
+    The userid occupies the upper 32 bits, the number of days since 1970-01-01 the next 21 bits and
+    the deviceid the lowest 10 bits of each key.
+
+    Args:
+        userid (numpy.ndarray): The user ids.
+        date (numpy.ndarray or None): The dates as datetime64. If None, only userid and deviceid
+            are packed.
+        deviceid (numpy.ndarray): The device ids.
+
+    Returns:
+        numpy.ndarray: The packed keys.
+    """
+    userid = np.asarray(userid, dtype=np.int64)
+    deviceid = np.asarray(deviceid, dtype=np.int64)
+
+    if date is None:
+        days = np.zeros(len(userid), dtype=np.int64)
+    else:
+        days = np.asarray(date).astype('datetime64[D]').astype(np.int64)
+
+    fields = (('userid', userid, 32), ('date', days, 21), ('deviceid', deviceid, 10))
+
+    for name, values, bits in fields:
+        if len(values) and (values.min() < 0 or values.max() >= 2**bits):
+            raise ValueError(f'Values of {name} do not fit into {bits} bits.')
+
+    return (userid << 31) | (days << 10) | deviceid
+
+
+def get_dummy_entries(surveys, vitals, devices=None):
     """
     Create a sequence of dummy entries at which the average vital data in the past 28 days will be
     computed.
@@ -21,24 +67,33 @@ def get_dummy_entries(surveys, vitals):
     survey. In that case a NaN entry for the vitals needs to be inserted on that date, so that this
     entry can serve as the anchor point for computing a rolling average over the past 28 days.
 
+    Each dummy entry is flagged by whether an entry for the same userid, date and deviceid already
+    exists in the vital data, so that only the missing entries need to be inserted later on.
+
     Args:
         surveys (pandas.DataFrame): The preprocessed survey data.
         vitals (pandas.DataFrame): The preprocessed vital data.
+        devices (numpy.ndarray, optional): The device types for which dummy entries are created.
+            Defaults to None, i.e., all device types in the vital data.
 
     Returns:
-        pandas.DataFrame: The dummy entries.
+        pandas.DataFrame: The dummy entries with columns 'userid', 'date', 'deviceid' and 'exists'.
     """
-    # Get all combination of userid and date for which we have survey responses
-    entries = surveys[['userid', 'date']]
-
     # Get the list of all device types
-    devices = vitals.deviceid.unique()
-
-    # Create a combination of userid and date for each device
-    dummy_entries = pd.concat([entries] * len(devices))
-
-    # Add each device type to each combination of users and date.
-    dummy_entries['deviceid'] = np.repeat(devices, len(surveys))
+    if devices is None:
+        devices = vitals.deviceid.unique()
+
+    # Create a combination of userid and date for which we have survey responses for each device
+    dummy_entries = pd.DataFrame({
+        'userid': np.tile(surveys.userid.values, len(devices)),
+        'date': np.tile(surveys.date.values, len(devices)),
+        'deviceid': np.repeat(devices, len(surveys))
+    })
+
+    dummy_entries['exists'] = np.isin(
+        pack_keys(dummy_entries.userid, dummy_entries.date, dummy_entries.deviceid),
+        pack_keys(vitals.userid, vitals.date, vitals.deviceid)
+    )
 
     return dummy_entries
 
@@ -63,62 +118,102 @@ def select_subset(vitals, subset):
     return vitals
 
 
+def select_missing_dummy_entries(dummy_entries, subset):
+    """
+    Select the dummy entries that are missing from a given subset of the vital data.
+
+    A dummy entry is missing from the subset if it does not exist in the vital data at all or if
+    its date is not part of the subset (e.g. a weekday for the subset 'weekend').
+
+    Args:
+        dummy_entries (pandas.DataFrame): The dummy entries as generated by get_dummy_entries().
+        subset (str): Indicator of the subset of vital data ('weekend', 'weekday' or 'total').
+
+    Returns:
+        pandas.DataFrame: The missing dummy entries with columns 'userid', 'date' and 'deviceid'.
+    """
+    missing = ~dummy_entries.exists
+
+    if subset in ('weekend', 'weekday'):
+        weekend = dummy_entries.date.dt.dayofweek >= 5
+        missing |= ~weekend if subset == 'weekend' else weekend
+
+    return dummy_entries.loc[missing, ['userid', 'date', 'deviceid']]
+
+
 def expand_vitals(vitals, dummy_entries):
     """
     Add a set of dummy entries at dates when surveys are present to the vital data.
 
     Args:
         vitals (pandas.DataFrame): The preprocessed vital data.
-        dummy_entries (pandas.DataFrame): The dummy entries of vital data as generated by
-            get_dummy_entries().
+        dummy_entries (pandas.DataFrame): The dummy entries of vital data that are missing from
+            vitals as generated by select_missing_dummy_entries().
 
     Returns:
         pandas.DataFrame: The vital data with added dates and corresponding NaN values when survey
             data is present.
     """
-
-    # Add the dummy entries to the list of vital data
-    vitals = pd.concat([vitals, dummy_entries]).reset_index(drop=True)
-
-    # This ensures that if an entry of the dummy entries already exists in the vital data, that
-    # entry is removed.
-    vitals.drop_duplicates(subset=['userid', 'date', 'deviceid'], keep='first', inplace=True)
-
-    return vitals
+    return pd.concat([vitals, dummy_entries]).reset_index(drop=True)
 
 
-def compute(surveys, vitals, min_periods, subset):
+def compute_windows(surveys, vitals, subset, dummy_entries=None):
     """
-    Compute 28-day rolling averages of a given subset of vital data for dates of survey responses.
+    Compute 28-day rolling averages, standard deviations and numbers of observations of a given
+    subset of vital data for dates of survey responses.
+
+    The averages are computed for every window with at least one observation, so that different
+    thresholds for the minimum number of observations can be applied later on with
+    apply_min_periods() without recomputing the windows.
 
     Args:
         surveys (pandas.DataFrame): The preprocessed survey data.
         vitals (pandas.DataFrame): The preprocessed vital data.
-        min_periods (int): The minimum number of days with values for the rolling average to be
-            computed.
-        subset (_type_): _description_
+        subset (str): Indicator of which vital data to use ('weekend', 'weekday' or '' for all).
+        dummy_entries (pandas.DataFrame, optional): The dummy entries as generated by
+            get_dummy_entries(). Defaults to None, in which case they are created from surveys and
+            vitals. Pass them in to reuse them across subsets.
 
     Returns:
-        df: The resulting DataFrame
+        pandas.DataFrame: The rolling average, standard deviation and number of observations of
+            each vital per userid, deviceid and date.
     """
     print('Compute 28-day rolling average of vitals for subset:', subset)
 
-    print('Create dummy table...')
-    dummy_entries = get_dummy_entries(surveys, vitals)
+    if dummy_entries is None:
+        print('Create dummy table...')
+        dummy_entries = get_dummy_entries(surveys, vitals)
 
     print('Expand vitals with dummy table...')
     vitals = select_subset(vitals, subset)
-    vitals = expand_vitals(vitals, dummy_entries)
+    vitals = vitals[['userid', 'date', 'deviceid', 'v9', 'v43', 'v65', 'v52', 'v53']]
+    vitals = expand_vitals(vitals, select_missing_dummy_entries(dummy_entries, subset))
 
     # Set midsleep before computing the rolling averages
     vitals['midsleep'] = 0.5 * (vitals['v53'] + vitals['v52'])
 
-    print('Compute rolling mean and std...')
+    print('Compute rolling mean, std and count...')
     df = vitals.set_index('date').sort_index()
-    df =df.groupby(['userid', 'deviceid']).rolling('28D',  min_periods=min_periods)
-    df = df['v9', 'v43', 'v65', 'v52', 'v53', 'midsleep'].agg(['mean', 'std'])
-
-    df.columns = [f'{column[0]}{column[1]}{subset}'.replace('mean', '') for column in df.columns]
+    df = df.groupby(['userid', 'deviceid']).rolling('28D', min_periods=0)[ROLLING_VITALS]
+    mean, std, count = df.mean(), df.std(), df.count()
+
+    df = pd.DataFrame(index=mean.index)
+    for vital in ROLLING_VITALS:
+        df[f'{vital}{subset}'] = mean[vital]
+        df[f'{vital}std{subset}'] = std[vital]
+        df[f'{vital}count{subset}'] = count[vital]
+
+    # Only keep the averages at the dummy entries, i.e., at the dates of survey responses
+    keys = df.index
+    is_anchor = np.isin(
+        pack_keys(
+            keys.get_level_values('userid'),
+            keys.get_level_values('date'),
+            keys.get_level_values('deviceid')
+        ),
+        pack_keys(dummy_entries.userid, dummy_entries.date, dummy_entries.deviceid)
+    )
+    df = df[is_anchor]
     df.reset_index(inplace=True)
 
     print('Done!')
@@ -126,6 +221,56 @@ def compute(surveys, vitals, min_periods, subset):
     return df
 
 
+def apply_min_periods(df, min_periods, subset):
+    """
+    Discard rolling averages and standard deviations of windows with too few observations.
+
+    Args:
+        df (pandas.DataFrame): The rolling averages as computed by compute_windows().
+        min_periods (int): The minimum number of days with values for the rolling average to be
+            computed.
+        subset (str): Indicator of which vital data to use ('weekend', 'weekday' or '' for all).
+
+    Returns:
+        pandas.DataFrame: The rolling averages without the numbers of observations.
+    """
+    counts = [f'{vital}count{subset}' for vital in ROLLING_VITALS]
+    result = df.drop(columns=counts)
+
+    for vital in ROLLING_VITALS:
+        too_few = (df[f'{vital}count{subset}'] < min_periods).values
+        result.loc[too_few, [f'{vital}{subset}', f'{vital}std{subset}']] = np.nan
+
+    return result
+
+
+def compute_all_windows(surveys, vitals, devices=None):
+    """
+    Compute the rolling averages, standard deviations and numbers of observations of all vitals
+    for all days, weekends and weekdays at the dates of survey responses.
+
+    Args:
+        surveys (pandas.DataFrame): The preprocessed survey data.
+        vitals (pandas.DataFrame): The preprocessed vital data.
+        devices (numpy.ndarray, optional): The device types for which averages are computed.
+            Defaults to None, i.e., all device types in the vital data.
+
+    Returns:
+        pandas.DataFrame: The windows of all subsets as computed by compute_windows().
+    """
+    # The dummy entries are the same for all subsets, so only create them once
+    print('Create dummy table...')
+    dummy_entries = get_dummy_entries(surveys, vitals, devices)
+
+    df = compute_windows(surveys, vitals, '', dummy_entries)
+
+    for subset in ('weekend', 'weekday'):
+        df_subset = compute_windows(surveys, vitals, subset, dummy_entries)
+        df = pd.merge(df, df_subset, on=['userid', 'deviceid', 'date'])
+
+    return df
+
+
 def compute_zscores(df, keys, by):
     """
     Compute Z-scores of given variables for specified sub-populations.
@@ -159,36 +304,46 @@ def compute_zscores(df, keys, by):
     return df
 
 
-@hydra.main(version_base=None, config_path='../config', config_name='main.yaml')
-def main(config):
+def merge_rolling_vitals(surveys, vitals, users, min_days, min_weekdays, min_weekenddays,
+                         devices=None, windows=None):
     """
-    Merge the survey, user and vital data into a consistent DataFrame for further analysis.
+    Merge the survey, user and vital data without computing Z-scores.
 
     Specifically, compute 28-day rolling averages of vital data for weekends, weekdays and all days
     in that period at dates when survey responses are present.
 
-    The resulting DataFrame is saved to disk.
-    """
-    input_path = Path(config.data.interim)
-    output_path = Path(config.data.processed)
-    output_path.mkdir(parents=True, exist_ok=True)
-
-    surveys = pd.read_feather(input_path / config.data.filenames.surveys)
-    vitals = pd.read_feather(input_path / config.data.filenames.vitals)
-    users = pd.read_feather(input_path / config.data.filenames.users)
+    Args:
+        surveys (pandas.DataFrame): The preprocessed survey data.
+        vitals (pandas.DataFrame): The preprocessed vital data.
+        users (pandas.DataFrame): The preprocessed user data.
+        min_days (int): The minimum number of days with values for the rolling average over all
+            days to be computed.
+        min_weekdays (int): The minimum number of weekdays with values for the rolling average over
+            weekdays to be computed.
+        min_weekenddays (int): The minimum number of weekend days with values for the rolling
+            average over weekend days to be computed.
+        devices (numpy.ndarray, optional): The device types for which averages are computed.
+            Defaults to None, i.e., all device types in the vital data.
+        windows (pandas.DataFrame, optional): Previously computed windows as returned by
+            compute_all_windows(). Defaults to None, in which case they are computed from surveys
+            and vitals.
 
-    # Compute average vitals for all valid 28-day periods
-    df = compute(surveys, vitals, config.process.min_days_for_averaging_vitals, subset='')
+    Returns:
+        pandas.DataFrame: The merged data.
+    """
+    if windows is None:
+        windows = compute_all_windows(surveys, vitals, devices)
 
-    # Append average vitals for weekends and weekdays during each 28-day period
+    # Only keep averages over all days, weekends and weekdays with enough observations
     settings = (
-        ('weekend', config.process.min_weekenddays_for_averaging_vitals),
-        ('weekday', config.process.min_weekdays_for_averaging_vitals)
+        ('', min_days),
+        ('weekend', min_weekenddays),
+        ('weekday', min_weekdays)
     )
 
+    df = windows
     for subset, min_periods in settings:
-        df_subset = compute(surveys, vitals, min_periods, subset)
-        df = pd.merge(df, df_subset, on=['userid', 'deviceid', 'date'])
+        df = apply_min_periods(df, min_periods, subset)
 
     # Compute weekend/weekday differences
     for vital in ('v9', 'v65', 'v43', 'v52', 'v53', 'midsleep'):
@@ -203,13 +358,325 @@ def main(config):
     df = pd.merge(surveys, df, on=['userid', 'date'])
     df = pd.merge(users, df, left_on='user_id', right_on='userid')
 
-    df = compute_zscores(
-        df,
-        keys=['q49', 'q50', 'q54', 'q55', 'q56', 'total_wellbeing'],
-        by=['salutation', 'birth_date']
+    return df
+
+
+def merge_data(surveys, vitals, users, min_days, min_weekdays, min_weekenddays, windows=None):
+    """
+    Merge the survey, user and vital data into a consistent DataFrame for further analysis.
+
+    See merge_rolling_vitals() for details. In addition, Z-scores of the survey responses are
+    computed for each combination of gender and birth year.
+
+    Args:
+        surveys (pandas.DataFrame): The preprocessed survey data.
+        vitals (pandas.DataFrame): The preprocessed vital data.
+        users (pandas.DataFrame): The preprocessed user data.
+        min_days (int): The minimum number of days with values for the rolling average over all
+            days to be computed.
+        min_weekdays (int): The minimum number of weekdays with values for the rolling average over
+            weekdays to be computed.
+        min_weekenddays (int): The minimum number of weekend days with values for the rolling
+            average over weekend days to be computed.
+        windows (pandas.DataFrame, optional): Previously computed windows as returned by
+            compute_all_windows(). Defaults to None, in which case they are computed from surveys
+            and vitals.
+
+    Returns:
+        pandas.DataFrame: The merged data.
+    """
+    df = merge_rolling_vitals(
+        surveys, vitals, users, min_days, min_weekdays, min_weekenddays, windows=windows)
+
+    return compute_zscores(df, keys=ZSCORE_KEYS, by=ZSCORE_BY)
+
+
+def isin_pairs(df, pairs):
+    """
+    Flag all rows of a DataFrame that belong to one of the given combinations of userid and
+    deviceid.
+
+    Args:
+        df (pandas.DataFrame): DataFrame with the columns 'userid' and 'deviceid'.
+        pairs (pandas.DataFrame): The combinations of userid and deviceid.
+
+    Returns:
+        numpy.ndarray: True for all rows that belong to one of the pairs.
+    """
+    return np.isin(
+        pack_keys(df.userid, None, df.deviceid),
+        pack_keys(pairs.userid, None, pairs.deviceid)
     )
 
-    df.to_feather(output_path / config.data.filenames.merged_data)
+
+def get_affected_pairs(changed_vitals, surveys):
+    """
+    Find all combinations of userid and deviceid whose rolling averages at any survey response
+    depend on changed vital data.
+
+    A change on a given day only affects the averages at survey responses within the following
+    28 days, so changes outside of that horizon are ignored.
+
+    Args:
+        changed_vitals (pandas.DataFrame): The userid, deviceid and date of changed vital data as
+            returned by get_changed_rows().
+        surveys (pandas.DataFrame): The preprocessed survey data.
+
+    Returns:
+        pandas.DataFrame: The affected combinations of userid and deviceid.
+    """
+    anchors = surveys[['userid', 'date']].rename(columns={'date': 'anchor'})
+
+    df = pd.merge(changed_vitals, anchors, on='userid')
+    lag = df.anchor - df.date
+    df = df[(lag >= pd.Timedelta(0)) & (lag < WINDOW)]
+
+    return df[['userid', 'deviceid']].drop_duplicates()
+
+
+def user_averages(df, keys, by):
+    """
+    Compute the average of the given variables for each user.
+
+    Args:
+        df (pandas.DataFrame): The merged data.
+        keys (list of string): The variables to average.
+        by (list of string): The criteria that define the sub-populations (e.g. age and/or gender).
+
+    Returns:
+        pandas.DataFrame: One row per user with the sub-population and the averaged variables.
+    """
+    agg = {b: 'max' for b in by}
+    agg.update({key: 'mean' for key in keys})
+
+    return df.groupby('user_id').agg(agg).reset_index()
+
+
+def apply_zscores(df, user_avg, keys, by):
+    """
+    Compute Z-scores of given variables from the averages of each user.
+
+    Adds the same columns as compute_zscores(). The statistics of each sub-population are computed
+    from the user averages exactly like in compute_zscores(), so the results are identical.
+
+    Args:
+        df (pandas.DataFrame): DataFrame containing the variables for which Z-scores are computed.
+        user_avg (pandas.DataFrame): The user averages as returned by user_averages().
+        keys (list of string): The keys of the variables for which Z-scores are computed.
+        by (list of string): The criteria that define the sub-populations (e.g. age and/or gender)
+
+    Returns:
+        df: The DataFrame with added columns for Z-scores
+    """
+    # Users in the same order as in compute_zscores() to obtain the very same sums
+    user_avg = user_avg.sort_values('user_id')
+    columns = list(df.columns)
+    avg = None
+
+    for key in keys:
+        key_avg = user_avg.groupby(by)[key].agg(['mean', 'std'])
+        key_avg.rename(
+            columns={'mean': key + '_demog_mean', 'std': key + '_demog_std'}, inplace=True)
+        avg = key_avg if avg is None else avg.join(key_avg)
+        columns += [key + '_demog_mean', key + '_demog_std', key + '_Z']
+
+    # Merge the statistics of all variables at once and only then compute the Z-scores
+    df = pd.merge(df, avg.reset_index(), on=by)
+
+    for key in keys:
+        df[key +'_Z'] = (df[key] - df[key + '_demog_mean']) / df[key + '_demog_std']
+
+    return df[columns]
+
+
+def merge_incremental(surveys, vitals, users, merged, state, settings):
+    """
+    Update a merged data set after some of the survey, vital or user data has changed.
+
+    Rolling averages are only recomputed for combinations of userid and deviceid with changed
+    vital data in the 28 days prior to any survey response and for all devices of users with
+    changed survey or user data. The results are spliced into the previous merged data, ordered
+    exactly as merge_data() would order them. Z-scores are recomputed from the stored averages of
+    all users.
+
+    Args:
+        surveys (pandas.DataFrame): The preprocessed survey data.
+        vitals (pandas.DataFrame): The preprocessed vital data.
+        users (pandas.DataFrame): The preprocessed user data.
+        merged (pandas.DataFrame): The previously merged data.
+        state (dict): The merge state of the previous run as returned by load_merge_state().
+        settings (dict): The thresholds and device types to use for merging.
+
+    Returns:
+        tuple: The updated merged data and merge state or (None, None) if the settings have changed
+            and a full merge is required.
+    """
+    if state['settings'] != settings:
+        return None, None
+
+    new_state = {
+        'surveys': fingerprint(surveys, ['userid', 'date']),
+        'vitals': fingerprint(vitals, ['userid', 'deviceid', 'date']),
+        'users': fingerprint(users, ['user_id']),
+        'settings': settings
+    }
+
+    # Users with changed survey or user data are recomputed for all devices
+    changed_users = np.union1d(
+        get_changed_rows(state['surveys'], new_state['surveys'], ['userid', 'date']).userid,
+        get_changed_rows(state['users'], new_state['users'], ['user_id']).user_id
+    )
+    changed_vitals = get_changed_rows(
+        state['vitals'], new_state['vitals'], ['userid', 'deviceid', 'date'])
+
+    devices = np.array(settings['devices'])
+    pairs = pd.concat([
+        get_affected_pairs(changed_vitals, surveys),
+        pd.DataFrame({
+            'userid': np.repeat(changed_users, len(devices)),
+            'deviceid': np.tile(devices, len(changed_users))
+        })
+    ]).drop_duplicates()
+
+    print('Recompute rolling averages for', len(pairs), 'combinations of user and device...')
+
+    affected_users = pairs.userid.unique()
+
+    recomputed = merge_rolling_vitals(
+        surveys[surveys.userid.isin(affected_users)],
+        vitals[isin_pairs(vitals, pairs)],
+        users[users.user_id.isin(affected_users)],
+        min_days=settings['min_days'],
+        min_weekdays=settings['min_weekdays'],
+        min_weekenddays=settings['min_weekenddays'],
+        devices=devices
+    )
+    recomputed = recomputed[isin_pairs(recomputed, pairs)]
+
+    # Replace the rows of all affected pairs and drop the previous Z-scores
+    zscore_columns = [
+        f'{key}{suffix}' for key in ZSCORE_KEYS for suffix in ('_demog_mean', '_demog_std', '_Z')
+    ]
+    merged = merged.drop(columns=zscore_columns)
+    df = pd.concat([merged[~isin_pairs(merged, pairs)], recomputed[merged.columns]])
+
+    # Restore the order of merge_data(), i.e., by user, then survey response, then device
+    user_position = pd.Series(np.arange(len(users)), index=users.user_id)
+    survey_position = pd.Series(
+        np.arange(len(surveys)), index=pd.MultiIndex.from_frame(surveys[['userid', 'date']]))
+    df['_user'] = user_position.reindex(df.user_id).values
+    df['_survey'] = survey_position.reindex(
+        pd.MultiIndex.from_frame(df[['userid', 'date']])).values
+    df.sort_values(['_user', '_survey', 'deviceid'], inplace=True, kind='stable')
+    df.drop(columns=['_user', '_survey'], inplace=True)
+    df.reset_index(drop=True, inplace=True)
+
+    # Update the averages of changed users
+    user_avg = state['user_averages']
+    changed = user_avg.user_id.isin(affected_users)
+    added = user_averages(df[df.user_id.isin(affected_users)], ZSCORE_KEYS, ZSCORE_BY)
+
+    new_state['user_averages'] = pd.concat(
+        [user_avg[~changed], added]).sort_values('user_id', ignore_index=True)
+
+    df = apply_zscores(df, new_state['user_averages'], ZSCORE_KEYS, ZSCORE_BY)
+
+    return df, new_state
+
+
+def run(config, surveys=None, vitals=None, users=None, writer=None):
+    """
+    Merge the survey, user and vital data and save the result to disk.
+
+    Preprocessed data that is not passed directly is read from 'data/02_interim'. The merged data
+    is stored in 'data/03_processed' together with the state needed for incremental updates. If
+    'merge.incremental' is set, only the parts of the previous merged data that depend on changed
+    inputs are recomputed. A full merge is done if there is no previous state, the state belongs to
+    a different merged file than the current output file (or an older version of it) or the
+    settings have changed.
+
+    Args:
+        config (omegaconf.DictConfig): The hydra configuration.
+        surveys (pandas.DataFrame, optional): The preprocessed survey data. Defaults to None.
+        vitals (pandas.DataFrame, optional): The preprocessed vital data. Defaults to None.
+        users (pandas.DataFrame, optional): The preprocessed user data. Defaults to None.
+        writer (CheckpointWriter, optional): Writes the merged data in the background. Defaults \
+            to None, in which case it is written immediately.
+
+    Returns:
+        pandas.DataFrame: The merged data.
+    """
+    input_path = Path(config.data.interim)
+    output_path = Path(config.data.processed)
+    output_path.mkdir(parents=True, exist_ok=True)
+
+    if surveys is None:
+        surveys = pd.read_feather(input_path / config.data.filenames.surveys)
+    if vitals is None:
+        vitals = pd.read_feather(input_path / config.data.filenames.vitals)
+    if users is None:
+        users = pd.read_feather(input_path / config.data.filenames.users)
+
+    output_file = output_path / config.data.filenames.merged_data
+    state_path = Path(config.data.merge_state)
+
+    settings = {
+        'min_days': config.process.min_days_for_averaging_vitals,
+        'min_weekdays': config.process.min_weekdays_for_averaging_vitals,
+        'min_weekenddays': config.process.min_weekenddays_for_averaging_vitals,
+        'devices': sorted(int(device) for device in vitals.deviceid.unique())
+    }
+
+    df, state = None, None
+    if config.merge.incremental and output_file.exists():
+        previous_state = load_merge_state(state_path)
+
+        if previous_state is None:
+            print('No previous merge state found - do a full merge...')
+        elif previous_state['merged_data'] != file_signature(output_file):
+            print('Merge state does not belong to', output_file, '- do a full merge...')
+        else:
+            print('Update merged data incrementally...')
+            df, state = merge_incremental(
+                surveys, vitals, users, pd.read_feather(output_file), previous_state, settings)
+
+    if df is None:
+        # The windows do not depend on the thresholds, so they can be reused when only the
+        # thresholds change, e.g., during a sweep with hydra's --multirun
+        digest = input_digest(surveys, vitals)
+        windows = load_windows(state_path, digest)
+
+        if windows is None:
+            windows = compute_all_windows(surveys, vitals)
+            save_windows(windows, digest, state_path, writer)
+        else:
+            print('Reuse rolling averages from previous run...')
+
+        df = merge_data(
+            surveys,
+            vitals,
+            users,
+            min_days=settings['min_days'],
+            min_weekdays=settings['min_weekdays'],
+            min_weekenddays=settings['min_weekenddays'],
+            windows=windows
+        )
+        state = get_merge_state(
+            surveys, vitals, users, user_averages(df, ZSCORE_KEYS, ZSCORE_BY), settings)
+
+    save_checkpoint(df, output_file, writer)
+    save_merge_state(state, state_path, output_file, writer)
+
+    return df
+
+
+@hydra.main(version_base=None, config_path='../config', config_name='main.yaml')
+def main(config):
+    """
+    Merge the survey, user and vital data into a consistent DataFrame for further analysis.
+    """
+    with CheckpointWriter() as writer:
+        run(config, writer=writer)
 
 
 if __name__ == "__main__":
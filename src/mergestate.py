@@ -0,0 +1,242 @@
+"""
+Store the state of the merge stage that allows to reuse work across runs.
+
+This covers (i) the state needed to update a merged data set incrementally, i.e., fingerprints of
+all inputs and the averages of each user, and (ii) the cached rolling averages of the vital data,
+which do not depend on the thresholds for the minimum number of observations. Both are stored in
+'data/03_processed/merge_state'. JSON files are written last and mark the stored data as
+complete.
+"""
+import hashlib
+import json
+from pathlib import Path
+import numpy as np
+import pandas as pd
+from src.utils.checkpoints import save_checkpoint
+
+
+def fingerprint(df, keys):
+    """
+    Compute a hash of each row of a DataFrame.
+
+    Args:
+        df (pandas.DataFrame): The DataFrame to fingerprint.
+        keys (list of string): The columns that identify each row.
+
+    Returns:
+        pandas.DataFrame: The identifying columns and a column 'hash' with the hash of each row.
+    """
+    fingerprints = df[keys].copy()
+    fingerprints['hash'] = pd.util.hash_pandas_object(df, index=False).values
+
+    return fingerprints
+
+
+def get_changed_rows(old, new, keys):
+    """
+    Find the rows that were added, removed or modified between two sets of fingerprints.
+
+    Since the hash of each row also covers its identifying columns, a row is unchanged if and only
+    if its hash is present in both sets of fingerprints.
+
+    Args:
+        old (pandas.DataFrame): The fingerprints of the previous input as created by fingerprint().
+        new (pandas.DataFrame): The fingerprints of the current input as created by fingerprint().
+        keys (list of string): The columns that identify each row.
+
+    Returns:
+        pandas.DataFrame: The identifying columns of all changed rows.
+    """
+    removed = old.loc[~np.isin(old.hash.values, new.hash.values), keys]
+    added = new.loc[~np.isin(new.hash.values, old.hash.values), keys]
+
+    return pd.concat([removed, added]).drop_duplicates()
+
+
+def get_merge_state(surveys, vitals, users, user_avg, settings):
+    """
+    Collect everything that is needed to update a merged data set incrementally later on.
+
+    Args:
+        surveys (pandas.DataFrame): The preprocessed survey data.
+        vitals (pandas.DataFrame): The preprocessed vital data.
+        users (pandas.DataFrame): The preprocessed user data.
+        user_avg (pandas.DataFrame): The averages of each user in the merged data as returned by
+            merge.user_averages().
+        settings (dict): The thresholds and device types used for merging.
+
+    Returns:
+        dict: Fingerprints of all inputs, user averages and the settings.
+    """
+    return {
+        'surveys': fingerprint(surveys, ['userid', 'date']),
+        'vitals': fingerprint(vitals, ['userid', 'deviceid', 'date']),
+        'users': fingerprint(users, ['user_id']),
+        'user_averages': user_avg,
+        'settings': settings
+    }
+
+
+def write_json(obj, path):
+    """
+    Write an object to a .json file.
+
+    Args:
+        obj (dict): The object to store.
+        path (str): Path to the desired output file.
+    """
+    with open(path, 'w', encoding='utf-8') as json_file:
+        json.dump(obj, json_file)
+
+
+def file_signature(path):
+    """
+    Describe a file by its absolute path, size and modification time.
+
+    Args:
+        path (str): Path to the file.
+
+    Returns:
+        dict: The signature of the file.
+    """
+    path = Path(path)
+    stat = path.stat()
+
+    return {'path': str(path.resolve()), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def write_merge_settings(settings, merged_file, path):
+    """
+    Write the settings of a merge together with the signature of the merged data it produced.
+
+    Args:
+        settings (dict): The thresholds and device types used for merging.
+        merged_file (str): Path to the merged data. Must already be written.
+        path (str): Path to the desired output file.
+    """
+    write_json({'settings': settings, 'merged_data': file_signature(merged_file)}, path)
+
+
+def save_merge_state(state, path, merged_file, writer=None):
+    """
+    Store the merge state as created by get_merge_state() in a folder.
+
+    The settings are written last and mark the state as complete. They also record the signature
+    of the merged data that the state belongs to, so the merged data must be written (or handed to
+    the same writer) before calling this function.
+
+    Args:
+        state (dict): The merge state.
+        path (str): Path to the folder. Typically 'data/03_processed/merge_state'.
+        merged_file (str): Path to the merged data the state belongs to.
+        writer (CheckpointWriter, optional): Writes the state in the background. Defaults to None,
+            in which case it is written immediately.
+    """
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+    (path / 'settings.json').unlink(missing_ok=True)
+
+    for name, df in state.items():
+        if name != 'settings':
+            save_checkpoint(df, path / f'{name}.feather', writer)
+
+    if writer is None:
+        write_merge_settings(state['settings'], merged_file, path / 'settings.json')
+    else:
+        writer.submit(write_merge_settings, state['settings'], merged_file, path / 'settings.json')
+
+
+def load_merge_state(path):
+    """
+    Load the merge state as stored by save_merge_state().
+
+    Args:
+        path (str): Path to the folder. Typically 'data/03_processed/merge_state'.
+
+    Returns:
+        dict: The merge state or None if no state is stored.
+    """
+    path = Path(path)
+
+    if not (path / 'settings.json').exists():
+        return None
+
+    with open(path / 'settings.json', encoding='utf-8') as settings_file:
+        settings = json.load(settings_file)
+
+    # States of earlier versions do not record the merged data they belong to
+    if 'merged_data' not in settings:
+        return None
+
+    names = ('surveys', 'vitals', 'users', 'user_averages')
+    state = {name: pd.read_feather(path / f'{name}.feather') for name in names}
+    state.update(settings)
+
+    return state
+
+
+def input_digest(surveys, vitals):
+    """
+    Compute a digest of all inputs that the rolling averages depend on.
+
+    Args:
+        surveys (pandas.DataFrame): The preprocessed survey data.
+        vitals (pandas.DataFrame): The preprocessed vital data.
+
+    Returns:
+        str: The hex digest.
+    """
+    digest = hashlib.sha256()
+
+    for df in (surveys[['userid', 'date']], vitals):
+        digest.update(pd.util.hash_pandas_object(df, index=False).values.tobytes())
+
+    return digest.hexdigest()
+
+
+def save_windows(windows, digest, path, writer=None):
+    """
+    Store the windows as computed by compute_all_windows() in a folder.
+
+    The digest is written last and marks the windows as complete.
+
+    Args:
+        windows (pandas.DataFrame): The windows.
+        digest (str): The digest of the inputs as returned by input_digest().
+        path (str): Path to the folder. Typically 'data/03_processed/merge_state'.
+        writer (CheckpointWriter, optional): Writes the windows in the background. Defaults to
+            None, in which case they are written immediately.
+    """
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+    (path / 'windows.json').unlink(missing_ok=True)
+
+    save_checkpoint(windows, path / 'windows.feather', writer)
+
+    if writer is None:
+        write_json({'digest': digest}, path / 'windows.json')
+    else:
+        writer.submit(write_json, {'digest': digest}, path / 'windows.json')
+
+
+def load_windows(path, digest):
+    """
+    Load the windows as stored by save_windows() if they were computed from the same inputs.
+
+    Args:
+        path (str): Path to the folder. Typically 'data/03_processed/merge_state'.
+        digest (str): The digest of the current inputs as returned by input_digest().
+
+    Returns:
+        pandas.DataFrame: The windows or None if no windows for the current inputs are stored.
+    """
+    path = Path(path)
+
+    if not (path / 'windows.json').exists():
+        return None
+
+    with open(path / 'windows.json', encoding='utf-8') as json_file:
+        if json.load(json_file)['digest'] != digest:
+            return None
+
+    return pd.read_feather(path / 'windows.feather')
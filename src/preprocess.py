@@ -6,6 +6,11 @@ import pandas as pd
 import numpy as np
 import hydra
 from omegaconf import DictConfig
+from src.geocache import load_zip_to_nuts, zip_to_nuts3
+from src.utils.checkpoints import CheckpointWriter, save_checkpoint
+
+# The WHO-5 questions in the order of the columns of the preprocessed survey data
+QUESTIONS = [49, 50, 54, 55, 56]
 
 
 def add_date_column(df):
@@ -139,7 +144,101 @@ def set_user_and_date_as_column(df):
     df.rename(columns={'user_id': 'userid'}, inplace=True)
 
 
-def preprocess_survey_data(input_file, output_file):
+def pack_survey_answers(df):
+    """
+    Pack the user id, day, question and choice of each raw survey answer into single int64 keys.
+
+    The user id occupies the upper 32 bits, the number of days since 1970-01-01 the next 16 bits,
+    the position of the question in QUESTIONS the next 3 bits and the choice the lowest 7 bits of
+    each key. Sorting the keys thus groups all answers by response and question.
+
+    Args:
+        df (pandas.DataFrame): The raw survey data as downloaded to 'data/01_raw'.
+
+    Returns:
+        numpy.ndarray: The packed keys.
+    """
+    userid = df.user_id.to_numpy(dtype=np.int64)
+    days = df.created_at.to_numpy(dtype=np.int64) // (1000 * 60 * 60 * 24)
+    choice = df.choice_id.to_numpy(dtype=np.int64)
+    question = df.question.to_numpy(dtype=np.int64)
+
+    position = np.searchsorted(QUESTIONS, question)
+    if not np.array_equal(np.take(QUESTIONS, position, mode='clip'), question):
+        raise ValueError(f'Found answers to questions other than {QUESTIONS}.')
+
+    fields = (('user_id', userid, 32), ('date', days, 16), ('choice_id', choice, 7))
+
+    for name, values, bits in fields:
+        if len(values) and (values.min() < 0 or values.max() >= 2**bits):
+            raise ValueError(f'Values of {name} do not fit into {bits} bits.')
+
+    return (userid << 26) | (days << 10) | (position << 7) | choice
+
+
+def unpack_survey_responses(keys):
+    """
+    Create one row with all five answers per survey response from packed survey answers.
+
+    Equivalent to drop_duplicate_entries(), put_response_to_each_question_as_column(),
+    remove_incomplete_responses(), simplify_column_names() and set_user_and_date_as_column() but
+    done in a single pass over the sorted keys: Repeated answers with the same choice count once,
+    questions with different choices on the same day are dropped and only responses with answers
+    to all five questions are kept. As with the pandas steps, the answers are integers unless any
+    response misses a question, in which case they are floats.
+
+    Args:
+        keys (numpy.ndarray): The keys as returned by pack_survey_answers().
+
+    Returns:
+        pandas.DataFrame: The survey responses in the format of preprocess_survey_data().
+    """
+    if len(keys) == 0:
+        return pd.DataFrame({
+            'userid': pd.Series(dtype=np.int64),
+            'date': pd.Series(dtype='datetime64[ns]'),
+            **{f'q{question}': pd.Series(dtype=float) for question in QUESTIONS},
+            'total_wellbeing': pd.Series(dtype=float),
+        })
+
+    keys = np.sort(keys)
+
+    # Each run of identical (user, day, question) holds all answers to that question on that day.
+    # Since the choice is stored in the lowest bits, the first and last entry of a run are the
+    # smallest and largest choice.
+    question_keys = keys >> 7
+    starts = np.flatnonzero(np.diff(question_keys, prepend=-1))
+    ends = np.append(starts[1:], len(keys)) - 1
+    choices = (keys[starts] & 0x7F).astype(np.int8)
+    unique = choices == (keys[ends] & 0x7F)
+
+    # A response is complete if it consists of five questions with unique choices
+    response_keys = question_keys[starts] >> 3
+    response_starts = np.flatnonzero(np.diff(response_keys, prepend=-1))
+    counts = np.add.reduceat(unique.astype(np.int8), response_starts)
+    complete = counts == len(QUESTIONS)
+
+    # Responses without any unique choice vanish entirely, all others would leave NaN entries
+    dtype = np.int64 if np.all(complete | (counts == 0)) else float
+    response_keys = response_keys[response_starts[complete]]
+
+    # Questions of complete responses form consecutive runs of five ordered like QUESTIONS
+    lengths = np.diff(np.append(response_starts, len(starts)))
+    answers = choices[np.repeat(complete, lengths)].reshape(-1, len(QUESTIONS))
+
+    df = pd.DataFrame({
+        'userid': response_keys >> 16,
+        'date': (response_keys & 0xFFFF).astype('datetime64[D]').astype('datetime64[ns]'),
+    })
+    for i, question in enumerate(QUESTIONS):
+        df[f'q{question}'] = answers[:, i].astype(dtype)
+
+    df['total_wellbeing'] = answers.sum(axis=1) / len(QUESTIONS)
+
+    return df
+
+
+def preprocess_survey_data(df):
     """
     Preprocess the raw survey data.
 
@@ -150,14 +249,22 @@ def preprocess_survey_data(input_file, output_file):
     1           250 2021-10-31  4.0  3.0  3.0  3.0  4.0              3.4
     ...         ...        ...  ...  ...  ...  ...  ...              ...
 
-    The final DataFrame is stored in 'data/02_processed' for further analysis.
+    Answers are deduplicated and reshaped from packed keys (see pack_survey_answers()). Data that
+    does not fit into these keys is processed with pandas instead.
 
     Args:
-        input_file (str): Path to the raw survey data. Typically stored in 'data/01_raw'.
-        output_file (str): Path to the desired output file. Typically stored in 'data/02_interim'.
-    """
+        df (pandas.DataFrame): The raw survey data as downloaded to 'data/01_raw'. Is modified in \
+            place if it does not fit into packed keys.
 
-    df = pd.read_feather(input_file)
+    Returns:
+        pandas.DataFrame: The preprocessed survey data.
+    """
+    try:
+        keys = pack_survey_answers(df)
+    except ValueError:
+        pass
+    else:
+        return unpack_survey_responses(keys)
 
     add_date_column(df)
     drop_duplicate_entries(df)
@@ -169,10 +276,10 @@ def preprocess_survey_data(input_file, output_file):
 
     df['total_wellbeing'] = df[['q49', 'q50', 'q54', 'q55', 'q56']].mean(axis=1)
 
-    df.to_feather(output_file)
+    return df
 
 
-def preprocess_vital_data(input_file, output_file):
+def preprocess_vital_data(df):
     """
     Preprocess the raw vital data.
 
@@ -190,28 +297,34 @@ def preprocess_vital_data(input_file, output_file):
     3             239 2021-09-04         6  10501.0  NaN  NaN  NaN   NaN     True
     ...           ...        ...       ...      ...  ...  ...  ...   ...      ...
 
-    The final DataFrame is stored in 'data/02_processed' for further analysis.
-
     Args:
-        input_file (str): Path to the raw vital data. Typically stored in 'data/01_raw'.
-        output_file (str): Path to the desired output file. Typically stored in 'data/02_interim'.
-    """
-    df = pd.read_feather(input_file)
+        df (pandas.DataFrame): The raw vital data as downloaded to 'data/01_raw'. Either with one \
+            row per vital (see download.get_vitals()) or with one column per vital \
+            (see download.get_vitals_wide()). Is modified in place.
 
+    Returns:
+        pandas.DataFrame: The preprocessed vital data.
+    """
     df['date'] = pd.to_datetime(df['date'])
 
-    # Correct sleep timing for correct timezone
-    sleep_timing = df.vitalid.isin([52, 53])
-    df.loc[sleep_timing, 'value'] += df.loc[sleep_timing, 'timezone_offset'] * 60
-    df.drop(columns='timezone_offset', inplace=True)
-
-    # Put vital data as columns
-    df = df.set_index(['userid', 'date', 'deviceid', 'vitalid']).unstack()
-    df.columns = df.columns.droplevel(0)
-    df.columns.names = [None]
-    df.columns = [f'v{entry}' for entry in df.columns]
-
-    df.reset_index(inplace=True)
+    if 'vitalid' in df.columns:
+        # Correct sleep timing for correct timezone
+        sleep_timing = df.vitalid.isin([52, 53])
+        df.loc[sleep_timing, 'value'] += df.loc[sleep_timing, 'timezone_offset'] * 60
+        df.drop(columns='timezone_offset', inplace=True)
+
+        # Put vital data as columns
+        df = df.set_index(['userid', 'date', 'deviceid', 'vitalid']).unstack()
+        df.columns = df.columns.droplevel(0)
+        df.columns.names = [None]
+        df.columns = [f'v{entry}' for entry in df.columns]
+
+        df.reset_index(inplace=True)
+    else:
+        # Already put as columns and corrected for timezone in the data base. Vitals without any
+        # value are returned as empty object columns, though.
+        vitals = ['v9', 'v43', 'v52', 'v53', 'v65']
+        df[vitals] = df[vitals].astype(float)
 
     # Compute onset and offset
     df['v52'] = (pd.to_datetime(df['v52'], unit='s') - df['date']) / pd.Timedelta(hours=1)
@@ -238,53 +351,91 @@ def preprocess_vital_data(input_file, output_file):
     df['weekend'] = df.date.dt.dayofweek >= 5
 
     df.reset_index(drop=True, inplace=True)
-    df.to_feather(output_file)
 
+    return df
 
-def preprocess_users(input_file, output_file, zip_to_nuts_mapping_file, age_level1, age_level2):
+
+def assign_age_groups(age, age_level1, age_level2):
     """
-    Add NUTS3 codes to user data and drop unnecessary columns.
+    Assign each age to one of three age groups.
 
-    The final DataFrame is stored in 'data/02_processed' for further analysis.
+    Ages in [0, age_level1) are assigned to group 0, ages in [age_level1, age_level2) to group 1
+    and ages in [age_level2, 100) to group 2. All other ages (including NaN) get no group.
 
     Args:
-        input_file (str): Path to the raw user data. Typically stored in 'data/01_raw'.
-        output_file (str): Path to the desired output file. Typically stored in 'data/02_interim'.
-        zip_to_nuts_mapping_file (str): Path to a .csv file containing the mapping of zip codes to \
-            NUTS3. Typically stored in 'data/00_external'.
+        age (numpy.ndarray): The ages of all users.
+        age_level1 (float): The lower bound of the second age group.
+        age_level2 (float): The lower bound of the third age group.
+
+    Returns:
+        numpy.ndarray: The age group of each user or NaN if no group applies.
     """
-    df = pd.read_feather(input_file)
+    age_group = np.digitize(age, [0, age_level1, age_level2, 100]) - 1.
 
-    # Compute age and define age groups
-    df['age'] = 2020 - df.birth_date + 2.5
-    df.loc[df['age'].between(0, age_level1, inclusive='left'), 'age_group'] = 0
-    df.loc[df['age'].between(age_level1, age_level2, inclusive='left'), 'age_group'] = 1
-    df.loc[df['age'].between(age_level2, 100, inclusive='left'), 'age_group'] = 2
+    # np.digitize puts ages below 0 into bin -1 and ages of at least 100 (or NaN) into bin 3
+    age_group[(age_group < 0) | (age_group > 2)] = np.nan
 
-    # Drop users with survey reponses that are too early
-    df = df[~df.user_id.isin([1143114, 1143193, 1144681, 1147298, 1144157, 1155559])]
+    return age_group
 
-    # Drop users with unreasonable birth dates
-    df = df[~df.birth_date.isin([2004, 1984, 2005])]
 
-    # Drop users with salution 'D' due to the low sample size
-    df = df[df.salutation != 'D']
+def preprocess_users(df, zip_to_nuts_mapping_file, zip_to_nuts_cache_file, age_level1, age_level2):
+    """
+    Add NUTS3 codes to user data and drop unnecessary columns.
 
-    plz = pd.read_csv(zip_to_nuts_mapping_file, sep=';')
+    Args:
+        df (pandas.DataFrame): The raw user data as downloaded to 'data/01_raw'. Is modified in \
+            place.
+        zip_to_nuts_mapping_file (str): Path to a .csv file containing the mapping of zip codes to \
+            NUTS3. Typically stored in 'data/00_external'.
+        zip_to_nuts_cache_file (str): Path to the cached lookup array of zip codes to NUTS3. Is \
+            created from zip_to_nuts_mapping_file if necessary. Typically stored in \
+            'data/00_external/cache'.
+        age_level1 (float): The lower bound of the second age group.
+        age_level2 (float): The lower bound of the third age group.
+
+    Returns:
+        pandas.DataFrame: The preprocessed user data.
+    """
+    # Compute age and define age groups
+    df['age'] = 2020 - df.birth_date + 2.5
+    df['age_group'] = assign_age_groups(df['age'].values, age_level1, age_level2)
+
+    keep = (
+        # Drop users with survey reponses that are too early
+        ~df.user_id.isin([1143114, 1143193, 1144681, 1147298, 1144157, 1155559])
+        # Drop users with unreasonable birth dates
+        & ~df.birth_date.isin([2004, 1984, 2005])
+        # Drop users with salution 'D' due to the low sample size
+        & (df.salutation != 'D')
+    )
 
-    plz.NUTS3 = plz.NUTS3.str.replace('\'', '')
-    plz.CODE = plz.CODE.str.replace('\'', '')
+    # Apply all filters at once so that the user table is only copied a single time
+    df = df.loc[keep.values, df.columns.drop('creation_timestamp')]
+    df.reset_index(drop=True, inplace=True)
 
-    df = pd.merge(df, plz, left_on='zip_5digit', right_on='CODE', how='left')
-    df.drop(columns=['creation_timestamp', 'CODE'], inplace=True)
+    index, codes = load_zip_to_nuts(zip_to_nuts_mapping_file, zip_to_nuts_cache_file)
+    df['NUTS3'] = zip_to_nuts3(df.zip_5digit, index, codes)
 
-    df.to_feather(output_file)
+    return df
 
 
-@hydra.main(version_base=None, config_path='../config', config_name='main.yaml')
-def main(config: DictConfig):
+def run(config, surveys=None, vitals=None, users=None, writer=None):
     """
     Preprocess survey, vital and user data for further analysis.
+
+    Raw data that is not passed directly is read from 'data/01_raw'. The preprocessed data is
+    stored in 'data/02_interim'.
+
+    Args:
+        config (omegaconf.DictConfig): The hydra configuration.
+        surveys (pandas.DataFrame, optional): The raw survey data. Defaults to None.
+        vitals (pandas.DataFrame, optional): The raw vital data. Defaults to None.
+        users (pandas.DataFrame, optional): The raw user data. Defaults to None.
+        writer (CheckpointWriter, optional): Writes the preprocessed data in the background. \
+            Defaults to None, in which case it is written immediately.
+
+    Returns:
+        dict: The preprocessed survey, vital and user data.
     """
     external_path = Path(config.data.external)
     input_path = Path(config.data.raw)
@@ -292,28 +443,42 @@ def main(config: DictConfig):
     output_path.mkdir(parents=True, exist_ok=True)
 
     print('Preprocess survey data...')
-    preprocess_survey_data(
-        input_file=input_path / config.data.filenames.surveys,
-        output_file=output_path / config.data.filenames.surveys
-    )
+    if surveys is None:
+        surveys = pd.read_feather(input_path / config.data.filenames.surveys)
+    surveys = preprocess_survey_data(surveys)
+    save_checkpoint(surveys, output_path / config.data.filenames.surveys, writer)
 
     print('Preprocess vital data...')
-    preprocess_vital_data(
-        input_file=input_path / config.data.filenames.vitals,
-        output_file=output_path / config.data.filenames.vitals
-    )
+    if vitals is None:
+        vitals = pd.read_feather(input_path / config.data.filenames.vitals)
+    vitals = preprocess_vital_data(vitals)
+    save_checkpoint(vitals, output_path / config.data.filenames.vitals, writer)
 
     print('Preprocess user data...')
-    preprocess_users(
-        input_file=input_path / config.data.filenames.users,
-        output_file=output_path / config.data.filenames.users,
+    if users is None:
+        users = pd.read_feather(input_path / config.data.filenames.users)
+    users = preprocess_users(
+        users,
         zip_to_nuts_mapping_file=external_path / config.data.filenames.zip_to_nuts,
+        zip_to_nuts_cache_file=Path(config.data.cache) / config.data.filenames.zip_to_nuts_cache,
         age_level1=config.process.users.age_level1,
         age_level2=config.process.users.age_level2
     )
+    save_checkpoint(users, output_path / config.data.filenames.users, writer)
 
     print('Done!')
 
+    return {'surveys': surveys, 'vitals': vitals, 'users': users}
+
+
+@hydra.main(version_base=None, config_path='../config', config_name='main.yaml')
+def main(config: DictConfig):
+    """
+    Preprocess survey, vital and user data for further analysis.
+    """
+    with CheckpointWriter() as writer:
+        run(config, writer=writer)
+
 
 if __name__ == "__main__":
     main() # pylint: disable=E1120
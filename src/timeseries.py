@@ -0,0 +1,260 @@
+"""
+Store the preprocessed time series of each user in contiguous arrays for fast per-user access.
+
+Rows are sorted by user, device and date, so that the time series of each user and device occupies
+a contiguous block of rows. Each column is stored as a separate .npy file together with CSR-style
+offset arrays that mark where the block of each user and device starts. Loading a store memory-maps
+the columns, and the time series of a single user is then returned as views into these arrays
+instead of scanning the whole table.
+
+A store is laid out as follows:
+
+    users.npy         sorted unique user ids
+    user_offsets.npy  for each user the position of its first device in devices.npy
+    devices.npy       device id of each block of rows
+    offsets.npy       for each block the position of its first row in the columns
+    columns/          one .npy file per column, e.g., 'date.npy' or 'v9.npy'
+
+Stores of the preprocessed vital data and of the merged data are written to
+'data/03_processed/timeseries'.
+"""
+from functools import partial
+from pathlib import Path
+import numpy as np
+import pandas as pd
+import hydra
+
+
+def block_starts(*keys):
+    """
+    Find the positions at which any of a set of sorted key arrays changes its value.
+
+    Args:
+        *keys (numpy.ndarray): Arrays of equal length sorted jointly.
+
+    Returns:
+        numpy.ndarray: The position of the first row of each block of identical keys.
+    """
+    new_block = np.ones(len(keys[0]), dtype=bool)
+
+    for key in keys:
+        new_block[1:] &= key[1:] == key[:-1]
+
+    new_block[1:] = ~new_block[1:]
+
+    return np.flatnonzero(new_block)
+
+
+def build_timeseries_store(df, folder, user_key='userid', device_key='deviceid', date_key='date',
+                           exclude=()):
+    """
+    Store a DataFrame of time series as a set of .npy files sorted by user, device and date.
+
+    Only numeric, boolean and datetime columns are stored. Existing columns in folder are removed.
+
+    Args:
+        df (pandas.DataFrame): The time series with one row per user, device and date. Is not
+            modified.
+        folder (str): The folder in which to store the arrays.
+        user_key (str, optional): The column holding user ids. Defaults to 'userid'.
+        device_key (str, optional): The column holding device ids. Defaults to 'deviceid'.
+        date_key (str, optional): The column holding dates. Defaults to 'date'.
+        exclude (list of str, optional): Further columns that are not stored. Defaults to ().
+    """
+    folder = Path(folder)
+    column_folder = folder / 'columns'
+    column_folder.mkdir(parents=True, exist_ok=True)
+
+    for path in column_folder.glob('*.npy'):
+        path.unlink()
+
+    order = np.lexsort((df[date_key].values, df[device_key].values, df[user_key].values))
+    users = df[user_key].values[order]
+    devices = df[device_key].values[order]
+
+    starts = block_starts(users, devices)
+    user_starts = block_starts(users[starts])
+
+    np.save(folder / 'users.npy', users[starts][user_starts])
+    np.save(folder / 'user_offsets.npy', np.append(user_starts, len(starts)))
+    np.save(folder / 'devices.npy', devices[starts])
+    np.save(folder / 'offsets.npy', np.append(starts, len(df)))
+
+    for column in df.columns.drop([user_key, device_key, *exclude]):
+        values = df[column]
+
+        if not (
+            pd.api.types.is_numeric_dtype(values) or pd.api.types.is_datetime64_dtype(values)
+        ):
+            continue
+
+        np.save(column_folder / f'{column}.npy', values.to_numpy()[order])
+
+
+class TimeSeriesStore():
+    """
+    Per-user access to a store created by build_timeseries_store().
+
+    All columns are memory-mapped, so only the rows of users that are actually accessed are read
+    from disk. The returned time series are views into the stored arrays and must not be modified.
+
+    Example:
+        store = TimeSeriesStore('data/03_processed/timeseries/vitals')
+        series = store.series(1234, deviceid=6)
+        plt.plot(series['date'], series['v65'])
+    """
+
+    def __init__(self, folder, mmap_mode='r'):
+        """
+        Args:
+            folder (str): The folder passed to build_timeseries_store().
+            mmap_mode (str, optional): Passed to numpy.load(). Defaults to 'r'. Use None to load
+                all columns into memory.
+        """
+        folder = Path(folder)
+
+        self.users = np.load(folder / 'users.npy')
+        self.user_offsets = np.load(folder / 'user_offsets.npy')
+        self.devices = np.load(folder / 'devices.npy')
+        self.offsets = np.load(folder / 'offsets.npy')
+
+        self.columns = {
+            path.stem: np.load(path, mmap_mode=mmap_mode)
+            for path in sorted((folder / 'columns').glob('*.npy'))
+        }
+
+        self.user_positions = dict(zip(self.users.tolist(), range(len(self.users))))
+
+    def __len__(self):
+
+        return len(self.users)
+
+    def __contains__(self, userid):
+
+        return userid in self.user_positions
+
+    def user_devices(self, userid):
+        """
+        Get the devices of a user.
+
+        Args:
+            userid (int): The user id.
+
+        Returns:
+            numpy.ndarray: The device ids in ascending order.
+        """
+        position = self.user_positions[userid]
+
+        return self.devices[self.user_offsets[position]:self.user_offsets[position + 1]]
+
+    def rows(self, userid, deviceid=None):
+        """
+        Get the rows that hold the time series of a user.
+
+        Args:
+            userid (int): The user id.
+            deviceid (int, optional): Only return the rows of this device. Defaults to None, i.e.,
+                the rows of all devices of the user.
+
+        Returns:
+            slice: The rows of the user in each column.
+        """
+        position = self.user_positions[userid]
+        first, last = self.user_offsets[position], self.user_offsets[position + 1]
+
+        if deviceid is not None:
+            matches = np.flatnonzero(self.devices[first:last] == deviceid)
+
+            if len(matches) == 0:
+                raise KeyError(f'User {userid} has no data for device {deviceid}.')
+
+            first = first + matches[0]
+            last = first + 1
+
+        return slice(self.offsets[first], self.offsets[last])
+
+    def series(self, userid, deviceid=None, columns=None):
+        """
+        Get the time series of a user.
+
+        Rows are sorted by device and date.
+
+        Args:
+            userid (int): The user id.
+            deviceid (int, optional): Only return the time series of this device. Defaults to None,
+                i.e., the time series of all devices of the user.
+            columns (list of str, optional): The columns to return. Defaults to None, i.e., all
+                columns.
+
+        Returns:
+            dict of numpy.ndarray: Views into each of the requested columns.
+        """
+        rows = self.rows(userid, deviceid)
+        columns = self.columns.keys() if columns is None else columns
+
+        return {column: self.columns[column][rows] for column in columns}
+
+    def __iter__(self):
+        """
+        Iterate over the time series of all users and devices.
+
+        Yields:
+            tuple: The user id, the device id and the time series as returned by series().
+        """
+        for position, userid in enumerate(self.users.tolist()):
+            for block in range(self.user_offsets[position], self.user_offsets[position + 1]):
+                rows = slice(self.offsets[block], self.offsets[block + 1])
+                yield (
+                    userid,
+                    self.devices[block],
+                    {column: values[rows] for column, values in self.columns.items()}
+                )
+
+
+def run(config, vitals=None, merged=None, writer=None):
+    """
+    Build the time series stores of the preprocessed vital data and of the merged data.
+
+    Data that is not passed directly is read from 'data/02_interim' and 'data/03_processed'. The
+    stores are written to 'data/03_processed/timeseries'.
+
+    Args:
+        config (omegaconf.DictConfig): The hydra configuration.
+        vitals (pandas.DataFrame, optional): The preprocessed vital data. Defaults to None.
+        merged (pandas.DataFrame, optional): The merged data. Defaults to None.
+        writer (CheckpointWriter, optional): Builds the stores in the background. Defaults to None,
+            in which case they are built immediately.
+    """
+    timeseries_path = Path(config.data.timeseries)
+
+    if vitals is None:
+        vitals = pd.read_feather(Path(config.data.interim) / config.data.filenames.vitals)
+    if merged is None:
+        merged = pd.read_feather(Path(config.data.processed) / config.data.filenames.merged_data)
+
+    # The merged data holds the user id twice, once from the user data and once from the surveys
+    stores = (
+        (vitals, timeseries_path / 'vitals', ()),
+        (merged, timeseries_path / 'merged', ('user_id', ))
+    )
+
+    for df, folder, exclude in stores:
+        print('Store time series in', folder)
+
+        if writer is None:
+            build_timeseries_store(df, folder, exclude=exclude)
+        else:
+            writer.submit(partial(build_timeseries_store, df, folder, exclude=exclude))
+
+
+@hydra.main(version_base=None, config_path='../config', config_name='main.yaml')
+def main(config):
+    """
+    Build the time series stores of the preprocessed vital data and of the merged data.
+    """
+    run(config)
+    print('Done!')
+
+
+if __name__ == "__main__":
+    main() # pylint: disable=E1120
@@ -0,0 +1,82 @@
+"""
+Write the intermediate results of the pipeline stages to disk in a background thread.
+"""
+from concurrent.futures import ThreadPoolExecutor
+
+
+class CheckpointWriter():
+    """
+    Write DataFrames to feather files in a background thread.
+
+    This allows the pipeline to continue with the next computation while the results of the
+    previous one are written to disk. DataFrames must not be modified after they have been handed
+    to the writer.
+
+    Use as a context manager. Leaving the context waits for all pending writes and raises the first
+    error that occurred while writing. If the context is left because of an exception, that
+    exception is raised instead.
+    """
+
+    def __init__(self):
+
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='checkpoint-writer')
+        self.pending = []
+
+    def submit(self, function, *args):
+        """
+        Schedule a function to be called in the background.
+
+        Calls are executed one after the other in the order they were submitted.
+
+        Args:
+            function (callable): The function to call.
+            *args: The arguments passed to function.
+        """
+        self.pending.append(self.executor.submit(function, *args))
+
+    def write(self, df, path):
+        """
+        Schedule a DataFrame to be written to a feather file.
+
+        Args:
+            df (pandas.DataFrame): The DataFrame to store.
+            path (str): Path to the desired output file.
+        """
+        self.submit(df.to_feather, path)
+
+    def close(self):
+        """
+        Wait for all pending writes to finish.
+        """
+        self.executor.shutdown(wait=True)
+
+        for future in self.pending:
+            future.result()
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+
+        if exc_type is None:
+            self.close()
+        else:
+            # Do not mask the original exception with errors of the pending writes
+            self.executor.shutdown(wait=True)
+
+
+def save_checkpoint(df, path, writer=None):
+    """
+    Write a DataFrame to a feather file, either directly or through a CheckpointWriter.
+
+    Args:
+        df (pandas.DataFrame): The DataFrame to store.
+        path (str): Path to the desired output file.
+        writer (CheckpointWriter, optional): The writer to hand the DataFrame to. Defaults to None,
+            in which case the file is written immediately.
+    """
+    if writer is None:
+        df.to_feather(path)
+    else:
+        writer.write(df, path)
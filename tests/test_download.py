@@ -0,0 +1,98 @@
+"""
+Compare the vital data put as columns in the data base with the vital data put as columns during
+preprocessing.
+
+The data base is replaced by an in-memory SQLite data base with synthetic vital data.
+"""
+import sqlite3
+import unittest
+from unittest import mock
+import numpy as np
+import pandas as pd
+from src import download
+from src.preprocess import preprocess_vital_data
+
+
+def synthetic_vitals(seed=0):
+    """
+    Create raw vital data in the format of the table datenspende.vitaldata.
+    """
+    rng = np.random.default_rng(seed)
+
+    dates = pd.date_range('2021-08-20', '2023-01-10').strftime('%Y-%m-%d')
+    index = pd.MultiIndex.from_product(
+        [[1, 2, 3], dates, [4, 6], [9, 43, 52, 53, 65]],
+        names=['user_id', 'date', 'source', 'type']
+    )
+    df = index.to_frame(index=False)
+    df = df[rng.random(len(df)) < 0.8].reset_index(drop=True)
+
+    days = pd.to_datetime(df.date).values.astype('datetime64[s]').astype(np.int64)
+    values = {
+        9: rng.normal(8000, 3000, len(df)).round(),
+        43: rng.normal(420, 60, len(df)).round(),
+        52: days - 3600 + rng.normal(0, 3600, len(df)).round(),
+        53: days + 7 * 3600 + rng.normal(0, 3600, len(df)).round(),
+        65: rng.normal(60, 8, len(df)).round(),
+    }
+    df['value'] = np.select([df.type == vital for vital in values], list(values.values()))
+
+    # Include offsets that are missing or filtered out by the queries
+    df['timezone_offset'] = rng.choice([0, 60, 120, 180], len(df)).astype(object)
+    df.loc[rng.random(len(df)) < 0.1, 'timezone_offset'] = None
+
+    return df
+
+
+class TestGetVitalsWide(unittest.TestCase):
+
+    def setUp(self):
+
+        self.connection = sqlite3.connect(':memory:')
+        self.connection.execute("ATTACH ':memory:' AS datenspende")
+        self.connection.execute("""
+            CREATE TABLE datenspende.vitaldata (
+                user_id INTEGER, date TEXT, type INTEGER, value REAL, source INTEGER,
+                timezone_offset INTEGER
+            )
+        """)
+
+        self.vitals = synthetic_vitals()
+        self.connection.executemany(
+            'INSERT INTO datenspende.vitaldata VALUES (?, ?, ?, ?, ?, ?)',
+            self.vitals[['user_id', 'date', 'type', 'value', 'source', 'timezone_offset']]
+            .astype(object).itertuples(index=False)
+        )
+
+        patcher = mock.patch.object(
+            download, 'run_query', lambda query: pd.read_sql_query(query, self.connection))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.connection.close)
+
+    def test_same_as_client_side_pivot(self):
+
+        user_ids = self.vitals.user_id.unique()
+
+        long = preprocess_vital_data(download.get_vitals(user_ids))
+        wide = preprocess_vital_data(download.get_vitals_wide(user_ids))
+
+        self.assertGreater(len(long), 0)
+
+        keys = ['userid', 'date', 'deviceid']
+        pd.testing.assert_frame_equal(
+            long.sort_values(keys, ignore_index=True),
+            wide[long.columns].sort_values(keys, ignore_index=True)
+        )
+
+    def test_one_row_per_user_date_and_device(self):
+
+        wide = download.get_vitals_wide(self.vitals.user_id.unique())
+
+        self.assertFalse(wide.duplicated(['userid', 'date', 'deviceid']).any())
+        self.assertLessEqual(wide.date.max(), '2022-12-31')
+        self.assertGreaterEqual(wide.date.min(), '2021-09-01')
+
+
+if __name__ == '__main__':
+    unittest.main()